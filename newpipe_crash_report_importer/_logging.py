@@ -1,8 +1,11 @@
+import functools
 import logging
 
 import coloredlogs
 
 
+# loggers are singletons anyway, so we can just cache them instead of looking them up in the registry every time
+@functools.lru_cache(maxsize=None)
 def make_logger(child_name: str = None):
     main_logger = logging.getLogger("importer")
 
@@ -12,7 +15,51 @@ def make_logger(child_name: str = None):
     return main_logger
 
 
+# set once configure_logging has installed the handlers
+_configured = False
+
+
+def _cache_format_time(formatter: logging.Formatter):
+    """
+    The date format has a resolution of one second (milliseconds are added by the log format), so formatTime returns
+    the same string for all records logged within the same second. Caching the last result saves a time.strftime
+    call for most records.
+    """
+
+    format_time = formatter.formatTime
+
+    # key and value are stored as a single tuple, so that threads never see a mismatching pair
+    last = (None, None)
+
+    def cached_format_time(record: logging.LogRecord, datefmt: str = None):
+        nonlocal last
+
+        # %f is replaced with the milliseconds by coloredlogs, we can't cache that
+        if datefmt and "%f" in datefmt:
+            return format_time(record, datefmt)
+
+        key = (int(record.created), datefmt)
+        last_key, last_value = last
+
+        if key != last_key:
+            last_value = format_time(record, datefmt)
+            last = (key, last_value)
+
+        return last_value
+
+    formatter.formatTime = cached_format_time
+
+
 def configure_logging(force_colors: bool = False):
+    """
+    Sets up colored logging. Only the first call has an effect, subsequent calls are ignored.
+    """
+
+    global _configured
+
+    if _configured:
+        return
+
     # better log format: less verbose, but including milliseconds
     fmt = "%(asctime)s,%(msecs)03d %(name)s [%(levelname)s] %(message)s"
 
@@ -23,7 +70,16 @@ def configure_logging(force_colors: bool = False):
 
     coloredlogs.install(level=logging.INFO, fmt=fmt, **extra_kwargs)
 
+    handler, _ = coloredlogs.find_handler(
+        logging.getLogger(), coloredlogs.match_stream_handler
+    )
+
+    if handler is not None:
+        _cache_format_time(handler.formatter)
+
     # hide aiosmtpd's log spam
     # unfortunately, it can't be configured any more fine grainedly at this point
     # see https://github.com/aio-libs/aiosmtpd/issues/239 for more information
     logging.getLogger("mail").setLevel(logging.WARNING)
+
+    _configured = True
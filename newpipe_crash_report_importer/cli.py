@@ -1,13 +1,26 @@
 import asyncio
+import collections
+import dataclasses
 import functools
 import os
-from datetime import datetime
-from smtplib import LMTP
+import re
+import signal
+import socket
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from smtplib import LMTP, SMTPServerDisconnected
+from typing import Iterable, Iterator, Optional, Tuple
 
 import click
 import sentry_sdk
 from sentry_sdk.integrations.asyncio import AsyncioIntegration
 
+try:
+    # uvloop is optional, but if it's available, we prefer it over the (considerably slower) default event loop
+    import uvloop
+except ImportError:
+    uvloop = None
+
 from newpipe_crash_report_importer.lmtp_server import CustomLMTP
 from . import (
     DatabaseEntry,
@@ -25,10 +38,193 @@ from . import (
 logger = make_logger("cli")
 
 
+# same line ending normalization smtplib applies to str messages, which it skips for bytes
+_EOL_RE = re.compile(rb"(?:\r\n|\n|\r(?!\n))")
+
+# time in seconds the server waits for the pending uploads on shutdown
+# docker stop sends SIGKILL after 10 seconds by default, and we need some time to shut down afterwards, too
+_SHUTDOWN_TIMEOUT = 5
+
+# number of files after which the import command reports its progress
+_IMPORT_PROGRESS_INTERVAL = 100
+
+
 class UnknownPackageError(RuntimeError):
     pass
 
 
+class LMTPConnectionError(RuntimeError):
+    pass
+
+
+@dataclasses.dataclass(frozen=True, slots=True)
+class Config:
+    """
+    Settings of the server. The attributes are read from the environment variables of the same name in upper case.
+    """
+
+    own_dsn: str
+    newpipe_dsn: str
+    newpipe_legacy_dsn: str
+
+    @classmethod
+    def from_environment(cls) -> "Config":
+        return cls(
+            **{
+                field.name: os.environ[field.name.upper()]
+                for field in dataclasses.fields(cls)
+            }
+        )
+
+
+class RecentHashIds:
+    """
+    Bounded in-memory set of the hash IDs of recently handled entries.
+
+    Crash reports tend to arrive more than once (e.g., when users hit "send" twice, or when mails are re-imported).
+    Remembering the IDs of entries that have been stored successfully allows us to skip those duplicates before doing
+    any I/O. Once the set is full, the least recently seen IDs are evicted.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+
+        # number of lookups which found a known ID, i.e., the amount of duplicates skipped so far
+        self.hits = 0
+
+        # we just need the order, the values are irrelevant
+        self._hash_ids = collections.OrderedDict()
+
+    def lookup(self, hash_id: str) -> bool:
+        """
+        Checks whether an ID is known. Known IDs are counted as a hit and marked as recently seen again.
+        """
+
+        try:
+            self._hash_ids.move_to_end(hash_id)
+        except KeyError:
+            return False
+
+        self.hits += 1
+        return True
+
+    def add(self, hash_id: str):
+        self._hash_ids[hash_id] = None
+
+        if len(self._hash_ids) > self.max_size:
+            self._hash_ids.popitem(last=False)
+
+
+class PersistentLMTPClient:
+    """
+    Small wrapper around smtplib's LMTP client which keeps a single session open for an entire import run.
+
+    The connection (and therefore the LHLO handshake) is set up when entering the context, so that an unreachable
+    server is noticed before any mail is sent. Subsequent mails are sent through the same session. In case the server
+    drops the connection (e.g., because it has been restarted or the session timed out), we reconnect once and retry.
+
+    Failing to (re)connect raises an LMTPConnectionError.
+    """
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+
+        self._client: Optional[LMTP] = None
+
+    def _connect(self) -> LMTP:
+        logger.info("Connecting to LMTP server %s:%d", self.host, self.port)
+        client = LMTP()
+
+        try:
+            client.connect(self.host, self.port)
+
+            # send LHLO right away, so that it is done exactly once per session
+            client.ehlo_or_helo_if_needed()
+
+        except OSError as e:
+            client.close()
+            raise LMTPConnectionError(
+                f"Could not connect to LMTP server {self.host}:{self.port}: {e}"
+            ) from e
+
+        return client
+
+    def sendmail(self, from_addr: str, to_addrs: list, msg):
+        if self._client is None:
+            self._client = self._connect()
+
+        try:
+            return self._client.sendmail(from_addr, to_addrs, msg)
+
+        except SMTPServerDisconnected:
+            logger.warning("LMTP server closed the connection, reconnecting")
+            # make sure the old socket is released before opening a new one
+            self._client.close()
+            self._client = None
+            self._client = self._connect()
+            return self._client.sendmail(from_addr, to_addrs, msg)
+
+    def close(self):
+        if self._client is None:
+            return
+
+        try:
+            self._client.quit()
+        except SMTPServerDisconnected:
+            # nothing left to close, really
+            pass
+
+        self._client = None
+
+    def __enter__(self):
+        if self._client is None:
+            self._client = self._connect()
+
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def read_mail_file(filename: str) -> bytes:
+    # the mails are sent as-is, so there's no need to decode them
+    # a larger buffer reduces the amount of read syscalls for big mails
+    with open(filename, "rb", buffering=64 * 1024) as f:
+        data = f.read()
+
+    return _EOL_RE.sub(b"\r\n", data)
+
+
+def read_mail_files_ahead(
+    filenames: Iterable[str], read_ahead: int = 8
+) -> Iterator[Tuple[str, Future]]:
+    """
+    Reads mail files in a small thread pool while the caller is busy sending the previous ones, so that disk I/O and
+    network I/O overlap. At most read_ahead files are buffered at any time.
+
+    Yields (filename, future) tuples in the original order. The future's result is the file's contents, or the
+    exception raised while reading the file.
+    """
+
+    executor = ThreadPoolExecutor(max_workers=4)
+    pending = collections.deque()
+
+    try:
+        for filename in filenames:
+            pending.append((filename, executor.submit(read_mail_file, filename)))
+
+            if len(pending) >= read_ahead:
+                yield pending.popleft()
+
+        while pending:
+            yield pending.popleft()
+
+    finally:
+        # in case the caller stops early (e.g., on SIGINT), we don't want to wait for files nobody will ever send
+        executor.shutdown(cancel_futures=True)
+
+
 @click.group()
 @click.option("--force-colors", type=bool, default=False)
 def cli(force_colors):
@@ -43,30 +239,60 @@ def cli(force_colors):
 @click.option("--host", type=str, default="::1")
 @click.option("--port", type=int, default=8025)
 def serve(host, port):
+    config = Config.from_environment()
+
     # report errors in the importer to GlitchTip, too
-    own_dsn = os.environ["OWN_DSN"]
-    print(f"Reporting own errors to Sentry DSN {own_dsn}")
+    logger.info("Reporting own errors to Sentry DSN %s", config.own_dsn)
     sentry_sdk.init(
-        dsn=own_dsn,
+        dsn=config.own_dsn,
         debug=os.environ.get("DEBUG_SENTRY_SDK", False),
         integrations=[
             AsyncioIntegration()
         ],
+        # the default transport hands events over to a background thread through a bounded queue, and drops them once
+        # the queue is full, so crash storms won't block the event loop
+        # we allow for a somewhat larger backlog than the default, though
+        transport_queue_size=1000,
+        # every log record becomes a breadcrumb, we don't need that many of them per event
+        max_breadcrumbs=10,
+        shutdown_timeout=2,
+        # we only care about errors, so we don't want the SDK to do any performance tracing work
+        # note that setting traces_sample_rate to 0 would still enable tracing internally
+        enable_tracing=False,
     )
 
     # initialize storages
     directory_storage = DirectoryStorage("mails")
 
-    newpipe_dsn = os.environ["NEWPIPE_DSN"]
-    newpipe_legacy_dsn = os.environ["NEWPIPE_LEGACY_DSN"]
+    sentry_storage = GlitchtipStorage(config.newpipe_dsn, "org.schabi.newpipe")
+    legacy_storage = GlitchtipStorage(
+        config.newpipe_legacy_dsn, "org.schabi.newpipelegacy"
+    )
+
+    # maps the package names sent in the crash reports to the storage their reports are sent to
+    # support for new packages can be added here
+    glitchtip_storages = {
+        "org.schabi.newpipe": sentry_storage,
+        "org.schabi.newpipelegacy": legacy_storage,
+    }
 
-    sentry_storage = GlitchtipStorage(newpipe_dsn, "org.schabi.newpipe")
-    legacy_storage = GlitchtipStorage(newpipe_legacy_dsn, "org.schabi.newpipelegacy")
+    recent_hash_ids = RecentHashIds(50_000)
+
+    # the uploads to GlitchTip are done by a fixed number of worker tasks, so the LMTP sessions don't have to wait for
+    # them, and a burst of incoming mails doesn't result in just as many concurrent uploads
+    # the mails are written to the directory storage before we reply, though, so a mail that has been accepted is never
+    # only kept in memory
+    # once the queue is full, the sessions wait for the workers to catch up
+    upload_queue = asyncio.Queue(maxsize=1000)
+    upload_workers_count = 32
+
+    # hash IDs of the entries which are queued or being uploaded at the moment
+    pending_uploads = set()
 
     # define handler code as closure
     # TODO: this is not very elegant, should be refactored
     async def handle_received_mail(message: Message):
-        logger.info(f"Handling mail")
+        logger.info("Handling mail")
 
         try:
             entry = DatabaseEntry(message)
@@ -74,12 +300,24 @@ def serve(host, port):
             logger.exception("Error while parsing the message")
             return
 
-        logger.info(f"Entry date: {entry.date}")
+        logger.info("Entry date: %s", entry.date)
 
-        if entry.date.timestamp() > datetime.now().timestamp():
+        if entry.timestamp > time.time():
             logger.error("Exception occured in the future... How could that happen?")
             return
 
+        if recent_hash_ids.lookup(entry.hash_id):
+            logger.warning(
+                "Entry has been stored recently, skipping (%d duplicates skipped so far)",
+                recent_hash_ids.hits,
+            )
+            return
+
+        # the same mail may be delivered again before its upload has finished, it must not be queued twice
+        if entry.hash_id in pending_uploads:
+            logger.warning("Entry is being uploaded already, skipping")
+            return
+
         try:
             await directory_storage.save(entry)
         except AlreadyStoredError:
@@ -87,40 +325,116 @@ def serve(host, port):
 
         package = entry.newpipe_exception_info["package"]
 
+        glitchtip_storage = glitchtip_storages.get(package)
+
+        if glitchtip_storage is None:
+            raise UnknownPackageError("Unknown package: " + package)
+
+        pending_uploads.add(entry.hash_id)
+        await upload_queue.put((glitchtip_storage, entry))
+
+    async def upload_entry(glitchtip_storage: GlitchtipStorage, entry: DatabaseEntry):
         try:
-            if package == "org.schabi.newpipe":
-                await sentry_storage.save(entry)
-            elif package == "org.schabi.newpipelegacy":
-                await legacy_storage.save(entry)
-            else:
-                raise UnknownPackageError("Unknown package: " + package)
+            await glitchtip_storage.save(entry)
 
         except AlreadyStoredError:
             logger.warning("Already stored in GlitchTip storage, skipping")
 
         except GlitchtipError as e:
             logger.error("Failed to store error in GlitchTip: %s", e)
+            # don't remember the entry, so it can be retried
+            return
+
+        recent_hash_ids.add(entry.hash_id)
+
+    async def process_uploads():
+        while True:
+            glitchtip_storage, entry = await upload_queue.get()
+
+            try:
+                await upload_entry(glitchtip_storage, entry)
+
+            except Exception:
+                # the mail has been accepted already, so all we can do is to make sure the issue shows up in the log
+                # and in GlitchTip
+                logger.exception("Error while uploading entry to GlitchTip")
+                sentry_sdk.capture_exception()
+
+            finally:
+                pending_uploads.discard(entry.hash_id)
+                upload_queue.task_done()
 
     handler = CrashReportHandler(handle_received_mail)
 
-    loop = asyncio.new_event_loop()
+    # aiosmtpd creates a new protocol instance for every connection, and unless a hostname is passed, each of them
+    # performs a (blocking) reverse DNS lookup to find out the FQDN
+    # the result won't change while we're running, so we resolve it once
+    hostname = socket.getfqdn()
+
+    async def run_server():
+        loop = asyncio.get_running_loop()
 
-    loop.run_until_complete(
-        loop.create_server(
+        server = await loop.create_server(
             functools.partial(
                 CustomLMTP,
                 handler,
+                hostname=hostname,
                 ident="NewPipe crash report importer",
                 enable_SMTPUTF8=True,
             ),
             host=host,
             port=port,
         )
-    )
 
-    logger.info(f"server listening on {host}:{port}")
+        workers = [
+            asyncio.create_task(process_uploads()) for _ in range(upload_workers_count)
+        ]
+
+        # docker stop (among others) sends SIGTERM, which would kill the process right away by default
+        # SIGINT is taken care of by asyncio.run, which cancels this coroutine
+        stop = asyncio.Event()
+        loop.add_signal_handler(signal.SIGTERM, stop.set)
+
+        logger.info("server listening on %s:%d", host, port)
+
+        try:
+            await stop.wait()
+            logger.info("SIGTERM received, shutting down")
+
+        finally:
+            # stop accepting new connections
+            # we don't wait for the open sessions to be closed by the clients, mails they are still transferring are
+            # not acknowledged, so the sending MTA will try again later
+            server.close()
 
-    loop.run_forever()
+            # the queued mails have been accepted already, so we give the workers some time to upload them
+            try:
+                await asyncio.wait_for(upload_queue.join(), timeout=_SHUTDOWN_TIMEOUT)
+            except asyncio.TimeoutError:
+                # the entries can be found in the directory storage
+                logger.error(
+                    "Shutting down with %d entries not uploaded to GlitchTip yet",
+                    len(pending_uploads),
+                )
+                logger.debug(
+                    "Entries not uploaded: %s", ", ".join(sorted(pending_uploads))
+                )
+
+            for worker in workers:
+                worker.cancel()
+
+            await asyncio.gather(*workers, return_exceptions=True)
+
+            for storage in [directory_storage, *glitchtip_storages.values()]:
+                await storage.close()
+
+    if uvloop is not None:
+        logger.info("using uvloop event loop")
+        loop_factory = uvloop.new_event_loop
+    else:
+        loop_factory = None
+
+    asyncio.run(run_server(), loop_factory=loop_factory)
 
 
 # note that import is a protected keyword, so we have to specify the command name explicitly
@@ -129,26 +443,54 @@ def serve(host, port):
 @click.option("--host", type=str, default="::1")
 @click.option("--port", type=int, default=8025)
 def import_rfc822(filenames, host, port):
-    logger.info(f"Connecting to LMTP server {host}:{port}")
-    client = LMTP(host=host, port=port)
-
-    for filename in filenames:
-        try:
-            with open(filename) as f:
-                data = f.read()
-        except UnicodeDecodeError:
-            logger.exception("Failed to decode mail contents, skipping")
-
-        try:
-            logger.info(f"Importing RFC822 e-mail file {filename}")
-            client.sendmail("a@b.cde", ["crashreport@newpipe.net"], data)
-
-        except KeyboardInterrupt:
-            logger.error("SIGINT received, exiting")
-            return 1
-
-        except:
-            logger.exception("Error while trying to import RFC822 e-mail")
+    # we reuse one LMTP session for all the files
+    # smtplib resets the session by itself after failed transactions, so the next mail can be sent right away
+    # the files are read in the background while the previous ones are being sent
+    imported = failed = 0
+
+    try:
+        with PersistentLMTPClient(host, port) as client:
+            for filename, read_future in read_mail_files_ahead(filenames):
+                try:
+                    data = read_future.result()
+                except OSError:
+                    logger.exception("Failed to read mail file %s, skipping", filename)
+                    failed += 1
+                    continue
+
+                try:
+                    logger.debug("Importing RFC822 e-mail file %s", filename)
+                    client.sendmail("a@b.cde", ["crashreport@newpipe.net"], data)
+
+                except KeyboardInterrupt:
+                    logger.error("SIGINT received, exiting")
+                    return 1
+
+                except LMTPConnectionError:
+                    # without a connection, there's no point in trying the remaining files
+                    raise
+
+                except:
+                    logger.exception(
+                        "Error while trying to import RFC822 e-mail file %s", filename
+                    )
+                    failed += 1
+
+                else:
+                    imported += 1
+
+                    # logging every single file slows down large imports considerably, a sign of life now and then is
+                    # enough
+                    if imported % _IMPORT_PROGRESS_INTERVAL == 0:
+                        logger.info("Imported %d e-mail files so far", imported)
+
+    except LMTPConnectionError as e:
+        raise click.ClickException(str(e))
+
+    logger.info("Imported %d e-mail files, %d failed", imported, failed)
+
+    if failed:
+        raise click.ClickException(f"Failed to import {failed} e-mail files")
 
 
 if __name__ == "__main__":
@@ -1,7 +1,10 @@
+import json
 from datetime import datetime
+from functools import cached_property
 from email.utils import parsedate_to_datetime
 from hashlib import sha256
 
+from .exceptions import ParserError
 from .message import Message
 
 
@@ -28,7 +31,12 @@ class DatabaseEntry:
             self.date = parsedate_to_datetime(rfc822_message["date"])
             if self.date.year < 2010:
                 self.date = self.message.date_from_received_headers()
-                print(self.date)
+
+                if self.date is None:
+                    raise ParserError("Could not determine the date of the report")
+
+        # the UNIX timestamp is needed by the handler as well as the storages, so we calculate it just once
+        self.timestamp = int(self.date.timestamp())
 
     def to_dict(self):
         # we don't store the From header, as it's not needed for potential re-imports of the database, but could be
@@ -37,14 +45,30 @@ class DatabaseEntry:
         # repository... D'oh!
         return {
             "to": self.to,
-            "timestamp": int(self.date.timestamp()),
+            "timestamp": self.timestamp,
             "plaintext": self.plaintext,
             "newpipe-exception-info": self.newpipe_exception_info,
         }
 
+    def to_json(self) -> bytes:
+        # serializing the whole document at once is faster than streaming it through json.dump(), and the result can
+        # be written with a single call
+        return json.dumps(self.to_dict(), indent=2).encode()
+
+    @cached_property
     def hash_id(self):
-        hash = sha256((str(self.from_) + str(self.to)).encode())
-        hash.update(self.date.strftime("%Y%m%d%H%M%S").encode())
+        # used by the in-memory deduplication as well as every storage, so it's worth computing it just once
+        # the hash IDs are stored in all storages, so the input must stay the same: from + to + date formatted as
+        # %Y%m%d%H%M%S
+        # feeding the parts one by one yields the same digest as hashing the concatenated string, and formatting the
+        # date by hand saves the rather slow strftime call (note that %Y is not zero-padded on Linux)
+        date = self.date
+        hash = sha256(str(self.from_).encode())
+        hash.update(str(self.to).encode())
+        hash.update(
+            b"%d%02d%02d%02d%02d%02d"
+            % (date.year, date.month, date.day, date.hour, date.minute, date.second)
+        )
         return hash.hexdigest()
 
     def __hash__(self):
@@ -1,4 +1,3 @@
-import traceback
 from email.parser import Parser
 
 import sentry_sdk
@@ -8,6 +7,20 @@ from aiosmtpd.smtp import Envelope
 from . import make_logger
 
 
+# parsers don't keep any state between parse calls (every call uses a fresh FeedParser internally), so a single
+# instance can be shared by all handlers
+# we stick to the default (compat32) policy on purpose: the header values end up in the hash IDs, which must not change
+_PARSER = Parser()
+
+# the only addresses we accept mail for
+_ALLOWED_RCPTS = frozenset(
+    {
+        "crashreport@newpipe.net",
+        "crashreport@newpipe.schabi.org",
+    }
+)
+
+
 class CustomLMTP(LMTP):
     """
     A relatively simple wrapper around the LMTP/SMTP classes that implements some less obtrusive logging around
@@ -16,10 +29,8 @@ class CustomLMTP(LMTP):
     Required until https://github.com/aio-libs/aiosmtpd/issues/239 has been resolved.
     """
 
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-
-        self.custom_logger = make_logger("lmtp")
+    # shared by all connections
+    custom_logger = make_logger("lmtp")
 
     def _get_peer_name(self):
         return f"{self.session.peer[0]}:{self.session.peer[1]}"
@@ -52,7 +63,7 @@ class CrashReportHandler:
     async def handle_RCPT(
         self, server, session, envelope: Envelope, address: str, rcpt_options
     ):
-        if address not in ["crashreport@newpipe.net", "crashreport@newpipe.schabi.org"]:
+        if address not in _ALLOWED_RCPTS:
             return f"550 not handling mail for address {address}"
 
         envelope.rcpt_tos.append(address)
@@ -60,15 +71,18 @@ class CrashReportHandler:
 
     @staticmethod
     def convert_to_rfc822_message(envelope: Envelope):
-        return Parser().parsestr(envelope.content.decode())
+        # we have to parse the mail as a string: as we allow SMTPUTF8, headers may contain raw UTF-8, which
+        # BytesParser (or rather, compat32) would turn into Header objects with replacement characters
+        # those would change the hash IDs, and can't be serialized to JSON
+        # surrogateescape keeps the parser from failing on invalid UTF-8
+        return _PARSER.parsestr(envelope.content.decode("utf-8", "surrogateescape"))
 
     async def handle_DATA(self, server, session, envelope: Envelope):
         try:
             message = self.convert_to_rfc822_message(envelope)
 
-            # as the volume of incoming mails is relatively low (< 3 per minute usually) and reporting doesn't take
-            # very long, we can just do it here and don't require some message queue/worker setup
-            # the callback is defined as async, but can, due to the low volume, be implemented synchronously, too
+            # the sending MTA is waiting for our reply in the meantime, so the callback should only do what's
+            # necessary to not lose the message (e.g., write it to disk) and defer everything else
             await self.callback(message)
 
         except:
@@ -76,7 +90,7 @@ class CrashReportHandler:
             # want to notify the sending MTA, but have them report success of delivery
             # it's after all not their problem: if they got so far, the message was indeed delivered to our LMTP server
             # however, we want the exception to show up in the log
-            traceback.print_exc()
+            self.logger.exception("Error while handling incoming mail")
 
             # also, we want to report all kinds of issues to GlitchTip
             sentry_sdk.capture_exception()
@@ -4,10 +4,37 @@ import re
 import unicodedata
 from email.message import EmailMessage
 from email.utils import parsedate_to_datetime
+from functools import cached_property
 
-import bleach
+from bleach.sanitizer import Cleaner
 
-from .exceptions import ParserError
+from .exceptions import ParserError, NoPlaintextMessageFoundError
+
+
+# matches everything from the first opening to the last closing curly brace
+# (MULTILINE is not needed, as the pattern doesn't use any anchors)
+_JSON_RE = re.compile(r"({.*})", re.DOTALL)
+
+
+# Received: header added by our own mail servers when delivering the mail to the mailbox
+_RECEIVED_RE = re.compile(
+    r"by (?:mail\.orange-it\.de|mail\.commandnotfound\.org) \(Dovecot\) with LMTP id"
+)
+
+# building a cleaner sets up html5lib's parser and serializer, so we just do it once
+_CLEANER = Cleaner(tags=[], attributes={}, strip=True)
+
+# the only characters the cleaner changes when stripping all tags: markup, entities and control characters other than
+# tabs and line feeds (line breaks are converted to \n, too)
+_NEEDS_CLEANING_RE = re.compile(r"[<>&\x00-\x08\x0b-\x1f]")
+
+
+def _normalize_nfkd(data: str) -> str:
+    # the vast majority of crash reports is pure ASCII, which NFKD doesn't change at all
+    if data.isascii():
+        return data
+
+    return unicodedata.normalize("NFKD", data)
 
 
 class Message:
@@ -15,29 +42,49 @@ class Message:
     Represents an incoming mail fetched from the IMAP server.
     """
 
+    # ASCII is a subset of UTF-8, so there's no need to try it separately (which would mean scanning every non-ASCII
+    # payload twice)
     possible_charsets = [
-        "ascii",
         "utf-8",
         "windows-1252",
     ]
 
     def __init__(self, rfc822_message: EmailMessage):
         self.rfc822_message = rfc822_message
-        self.plaintext_or_html_part = self.get_plaintext_or_html_part()
+
+    # the attributes below are only computed on first access, so that callers which just need the headers don't pay
+    # for decoding and sanitizing the body
+
+    @cached_property
+    def plaintext_or_html_part(self):
+        part = self.get_plaintext_or_html_part()
+
+        if part is None:
+            raise NoPlaintextMessageFoundError(
+                "Message contains neither a text/plain nor a text/html part"
+            )
+
+        return part
+
+    @cached_property
+    def _decoded_payload(self) -> str:
         payload = self.plaintext_or_html_part.get_payload(decode=True)
 
         for charset in self.possible_charsets:
             try:
-                decoded_payload = payload.decode(charset)
+                return payload.decode(charset)
             except UnicodeDecodeError:
                 continue
-            else:
-                break
-        else:
-            raise ParserError("Could not decode message payload")
 
-        self.plaintext = self.sanitize_message(decoded_payload)
-        self.embedded_json = self.extract_json_from_string(self.plaintext)
+        raise ParserError("Could not decode message payload")
+
+    @cached_property
+    def plaintext(self) -> str:
+        return self.sanitize_message(self._decoded_payload)
+
+    @cached_property
+    def embedded_json(self):
+        return self.extract_json_from_string(self.plaintext)
 
     def get_plaintext_or_html_part(self):
         """
@@ -47,18 +94,37 @@ class Message:
         :return: The part or None
         :rtype: class:`email.message.Message`
         """
+        # messages parsed with the modern email API know how to find the body themselves
+        # they stop at the first match and skip attachments
+        if isinstance(self.rfc822_message, EmailMessage):
+            return self.rfc822_message.get_body(preferencelist=("plain", "html"))
+
+        # compat32 messages (e.g., the ones our LMTP server parses) don't support that, so we have to search ourselves
         for part in self.rfc822_message.walk():
             if part.get_content_type() in ("text/plain", "text/html"):
                 return part
-        else:
-            return None
+
+        return None
 
     @staticmethod
     def sanitize_message(original_data):
-        normalized = unicodedata.normalize("NFKD", original_data)
+        normalized = _normalize_nfkd(original_data)
         decoded = html.unescape(normalized)
-        sanitized = bleach.clean(decoded, tags=[], attributes={}, strip=True)
-        return unicodedata.normalize("NFKD", sanitized)
+
+        # parsing the text as HTML is by far the most expensive part, and most crash reports don't contain any markup
+        # for those, converting the line breaks is all the cleaner would do
+        sanitized = decoded.replace("\r\n", "\n").replace("\r", "\n")
+
+        # stripping tags or control characters can move combining characters next to each other, which then need to be
+        # reordered, so the cleaned text always needs a second pass
+        if _NEEDS_CLEANING_RE.search(sanitized):
+            return _normalize_nfkd(_CLEANER.clean(decoded))
+
+        # otherwise, only resolving HTML entities (e.g., &eacute;) can produce characters that aren't normalized yet
+        if "&" not in normalized:
+            return sanitized
+
+        return _normalize_nfkd(sanitized)
 
     @staticmethod
     def extract_json_from_string(json_string):
@@ -68,33 +134,33 @@ class Message:
         Although it's a really BAD idea to sanitize untrusted data, we'll give it
         a try - as long as there's no bugs in the JSON parser, it should be safe
         to do this.
+
+        Expects the string to be sanitized by sanitize_message() already, which
+        includes the Unicode normalization.
         """
 
-        match = re.search("({.*})", json_string, re.MULTILINE + re.DOTALL)
+        match = _JSON_RE.search(json_string)
 
         if match:
             try:
-                data = match.group(1)
-                data = unicodedata.normalize("NFKD", data)
-                return json.loads(data, strict=False)
+                # no need to normalize again, any substring of NFKD normalized
+                # text is normalized already
+                return json.loads(match.group(1), strict=False)
             except json.JSONDecodeError:
                 raise ParserError("Could not parse JSON in given data")
         else:
             raise ParserError("Could not find JSON in given data")
 
     def date_from_received_headers(self):
-        headers = self.rfc822_message.get_all("received")
-        header = None
-
-        for _h in headers:
-            for domain in ["mail.orange-it.de", "mail.commandnotfound.org"]:
-                if "by %s (Dovecot) with LMTP id" % domain in _h:
-                    break
-            else:
-                continue
-            header = _h
-            break
+        """
+        Extracts the date from the Received: header our own mail server added upon delivery.
 
-        date = parsedate_to_datetime(header.split(";")[-1].strip())
+        :return: The date or None, if there's no such header
+        :rtype: class:`datetime.datetime`
+        """
+        for header in self.rfc822_message.get_all("received", []):
+            if _RECEIVED_RE.search(header):
+                # the date is the last of the semicolon-separated parts
+                return parsedate_to_datetime(header.rsplit(";", 1)[-1].strip())
 
-        return date
+        return None
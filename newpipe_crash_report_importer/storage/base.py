@@ -8,3 +8,10 @@ class Storage:
 
     async def save(self, entry: DatabaseEntry) -> None:
         raise NotImplementedError()
+
+    async def close(self) -> None:
+        """
+        Releases resources held by the storage (e.g., network connections). Does nothing by default.
+        """
+
+        pass
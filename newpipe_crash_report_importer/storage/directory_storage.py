@@ -1,4 +1,4 @@
-import json
+import asyncio
 import os
 
 from . import AlreadyStoredError
@@ -16,15 +16,24 @@ class DirectoryStorage(Storage):
         self.directory = os.path.abspath(directory)
         os.makedirs(self.directory, exist_ok=True)
 
-    async def save(self, entry: DatabaseEntry):
-        message_id = entry.hash_id() + ".json"
+    def _save_sync(self, entry: DatabaseEntry):
+        message_id = entry.hash_id + ".json"
         subdir = os.path.join(
             self.directory, message_id[0], message_id[:3], message_id[:5]
         )
         os.makedirs(subdir, exist_ok=True)
         path = os.path.join(subdir, message_id)
-        if os.path.isfile(path):
+
+        # serialize first, so that we never leave behind an empty file
+        data = entry.to_json()
+
+        # exclusive creation fails if the file exists already, which saves a separate check
+        try:
+            with open(path, "xb") as f:
+                f.write(data)
+        except FileExistsError:
             raise AlreadyStoredError()
 
-        with open(path, "w") as f:
-            json.dump(entry.to_dict(), f, indent=2)
+    async def save(self, entry: DatabaseEntry):
+        # file system operations block, so we run them in a worker thread to keep the event loop responsive
+        await asyncio.to_thread(self._save_sync, entry)
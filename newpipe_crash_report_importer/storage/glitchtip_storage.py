@@ -1,16 +1,34 @@
+import asyncio
 import hashlib
 import json
-import re
 from typing import List, Union, Optional
 
 import aiohttp
 from sentry_sdk.utils import Dsn, Auth
 
 from . import Storage, AlreadyStoredError
+from .._logging import make_logger
 from ..database_entry import DatabaseEntry
 from ..exceptions import StorageError, ParserError
 
 
+logger = make_logger("glitchtip_storage")
+
+# uploads which time out, can't connect or fail with a server error are retried a few times, with exponentially
+# growing delays in between (0.5s, 1s, ...)
+_MAX_ATTEMPTS = 3
+_RETRY_BASE_DELAY = 0.5
+
+
+# format description: https://develop.sentry.dev/sdk/event-payloads/sdk/
+# it's the same for every event, so we only need to build it once
+_SDK = {
+    "name": "newpipe.crashreportimporter",
+    # we don't really care at all about the version, but it's supposed to be semver
+    "version": "0.0.1",
+}
+
+
 class SentryFrame:
     """
     Represents a Sentry stack frame payload.
@@ -20,6 +38,9 @@ class SentryFrame:
     Implements the value object pattern.
     """
 
+    # there's one of these per stack frame, so saving the per-instance __dict__ is worth it
+    __slots__ = ("filename", "function", "package", "lineno")
+
     def __init__(
         self, filename: str, function: str, package: str, lineno: Optional[int] = None
     ):
@@ -56,6 +77,8 @@ class SentryStacktrace:
     Implements the value object pattern.
     """
 
+    __slots__ = ("frames",)
+
     def __init__(self, frames: List[SentryFrame]):
         # the only mandatory element is the stack frames
         # we don't require any register values
@@ -76,6 +99,8 @@ class SentryException:
     Implements the value object pattern.
     """
 
+    __slots__ = ("type", "value", "module", "stacktrace")
+
     def __init__(
         self, type: str, value: str, module: str, stacktrace: SentryStacktrace
     ):
@@ -108,6 +133,16 @@ class SentryPayload:
     mutated by the caller. The list of attributes initialized below, however, is constant.
     """
 
+    __slots__ = (
+        "event_id",
+        "timestamp",
+        "message",
+        "exception",
+        "extra",
+        "tags",
+        "release",
+    )
+
     def __init__(
         self,
         event_id: str,
@@ -153,15 +188,6 @@ class SentryPayload:
         }
         self.release: Optional[str] = None
 
-    @staticmethod
-    def _render_sdk():
-        # format description: https://develop.sentry.dev/sdk/event-payloads/sdk/
-        return {
-            "name": "newpipe.crashreportimporter",
-            # we don't really care at all about the version, but it's supposed to be semver
-            "version": "0.0.1",
-        }
-
     def _render_exceptions(self):
         return {"values": [self.exception.to_json()]}
 
@@ -188,7 +214,7 @@ class SentryPayload:
             # sending None/null in case this won't cause any issues, so we can be lazy here
             "release": self.release,
             # for some annoying reason, GlitchTip insists on us specifying an SDK
-            "sdk": self._render_sdk(),
+            "sdk": _SDK,
             # we only report errors to GlitchTip (it's also the default value)
             "level": "error",
         }
@@ -233,20 +259,61 @@ class GlitchtipStorage(Storage):
     Used to store incoming mails on a GlitchTip server.
     https://app.glitchtip.com/docs/
 
-    Remembers already sent mail reports by putting their hash IDs in a file
-    in the application's working directory.
+    Doesn't keep track of the reports sent so far. The event IDs are derived from the entries' hash IDs, so GlitchTip
+    rejects duplicates by itself (see AlreadyStoredError).
     """
 
     def __init__(self, dsn: str, package: str):
         self.sentry_auth: Auth = Dsn(dsn).to_auth()
         self.package = package
 
+        # created lazily, see _get_session
+        self._session: Optional[aiohttp.ClientSession] = None
+
     @property
     def sentry_store_url(self):
         # we used to use Sentry SDK's auth helper object to calculate both the URL from the DSN string
         # since Sentry's SDK now uses the Envelope endpoint by default for ingestion, we need to build the URL ourselves
         return f"{self.sentry_auth.scheme}://{self.sentry_auth.host}{self.sentry_auth.path}api/{self.sentry_auth.project_id}/store/"
 
+    @staticmethod
+    def parse_frame(raw_frame: str) -> SentryFrame:
+        """
+        Parses a single Java stack frame, e.g., org.schabi.newpipe.Foo.bar(Foo.java:123).
+
+        The format is simple enough to be parsed by looking for the delimiters, which is a lot cheaper than running
+        regexes on every frame.
+        """
+
+        # Java/Kotlin method paths never contain parentheses, so the first pair of them encloses the location
+        # we must not search from the right: the last frame before a "Caused by:" block carries the cause's message,
+        # which may contain parentheses as well (e.g., "Fragment not attached (state=2)")
+        start = raw_frame.find("(")
+        end = raw_frame.find(")", start) if start >= 0 else -1
+
+        # we need both a module path and a location
+        if start <= 0 or end - start < 2:
+            raise ParserError("Could not parse frame: '{}'".format(raw_frame))
+
+        package, _, function = raw_frame[:start].rpartition(".")
+        location = raw_frame[start + 1 : end]
+
+        # "Unknown Source" is shown for lambda functions, "Native Method" for native ones
+        if ":" not in location:
+            # apparently a native exception, so we don't have a line number
+            return SentryFrame(location, function, package)
+
+        filename, _, lineno = location.rpartition(":")
+
+        try:
+            lineno = int(lineno)
+        except ValueError:
+            raise ValueError(
+                f"could not find filename and line number in string {location}"
+            )
+
+        return SentryFrame(filename.strip(), function, package, lineno=lineno)
+
     def make_sentry_payload(self, entry: DatabaseEntry):
         newpipe_exc_info = entry.newpipe_exception_info
 
@@ -265,78 +332,34 @@ class GlitchtipStorage(Storage):
 
         for raw_frame in raw_frames[1:]:
             # some very basic sanitation, as e-mail clients all suck
-            raw_frame = raw_frame.strip()
+            frames.append(self.parse_frame(raw_frame.strip()))
 
-            # _very_ basic but gets the job done well enough
-            frame_match = re.search(r"(.+)\(([a-zA-Z0-9:.\s]+)\)", raw_frame)
+        # e.g., "java.lang.RuntimeException: message"
+        # partition stops at the first delimiter and doesn't build any lists
+        exception_name, separator, rest = message.partition(":")
 
-            if frame_match:
-                module_path = frame_match.group(1).split(".")
-                filename_and_lineno = frame_match.group(2)
+        if separator:
+            module, _, type = exception_name.rpartition(".")
+            # only the part up to the next colon is used as value
+            value = rest.partition(":")[0]
 
-                if ":" in filename_and_lineno:
-                    # "unknown source" is shown for lambda functions
-                    filename_and_lineno_match = re.search(
-                        r"(Unknown\s+Source|(?:[a-zA-Z]+\.(?:kt|java)+)):([0-9]+)",
-                        filename_and_lineno,
-                    )
-
-                    if not filename_and_lineno_match:
-                        raise ValueError(
-                            f"could not find filename and line number in string {frame_match.group(2)}"
-                        )
-
-                    # we want just two matches, anything else would be an error in the regex
-                    assert len(filename_and_lineno_match.groups()) == 2
-
-                    frame = SentryFrame(
-                        filename_and_lineno_match.group(1),
-                        module_path[-1],
-                        ".".join(module_path[:-1]),
-                        lineno=int(filename_and_lineno_match.group(2)),
-                    )
-
-                    frames.append(frame)
-
-                else:
-                    # apparently a native exception, so we don't have a line number
-                    frame = SentryFrame(
-                        frame_match.group(2),
-                        module_path[-1],
-                        ".".join(module_path[:-1]),
-                    )
-
-                    frames.append(frame)
-
-            else:
-                raise ParserError("Could not parse frame: '{}'".format(raw_frame))
-
-        try:
-            type = message.split(":")[0].split(".")[-1]
-            value = message.split(":")[1]
-            module = ".".join(message.split(":")[0].split(".")[:-1])
-
-        except IndexError:
+        else:
             type = value = module = "<none>"
 
-        timestamp = entry.date.timestamp()
-
         # set up the payload, with all intermediary value objects
         stacktrace = SentryStacktrace(frames)
         exception = SentryException(type, value, module, stacktrace)
 
         # TODO: support multiple exceptions to support "Caused by:"
-        payload = SentryPayload(entry.hash_id(), timestamp, message, exception)
+        payload = SentryPayload(entry.hash_id, entry.timestamp, message, exception)
 
         # try to fill in as much optional data as possible
 
-        try:
-            # in Sentry, releases are now supposed to be unique organization wide
-            # in GlitchTip, however, they seem to be regarded as tags, so this should work well enough
-            payload.release = entry.newpipe_exception_info["version"]
-        except KeyError:
-            pass
+        # in Sentry, releases are now supposed to be unique organization wide
+        # in GlitchTip, however, they seem to be regarded as tags, so this should work well enough
+        payload.release = newpipe_exc_info.get("version")
 
+        # values explicitly set to null in the report are passed on as well
         for key in [
             "user_comment",
             "request",
@@ -344,55 +367,97 @@ class GlitchtipStorage(Storage):
             "content_country",
             "app_language",
         ]:
-            try:
+            if key in newpipe_exc_info:
                 payload.extra[key] = newpipe_exc_info[key]
-            except KeyError:
-                pass
 
         for key in ["os", "service", "content_language"]:
-            try:
+            if key in newpipe_exc_info:
                 payload.tags[key] = newpipe_exc_info[key]
-            except KeyError:
-                pass
 
-        try:
-            package = newpipe_exc_info["package"]
-        except KeyError:
-            package = None
+        package = newpipe_exc_info.get("package")
 
         if package is not None:
             if package != self.package:
                 raise ValueError("Package name not allowed: %s" % package)
             else:
-                payload.tags["package"] = newpipe_exc_info["package"]
+                payload.tags["package"] = package
 
         return payload
 
-    async def save(self, entry: DatabaseEntry):
-        exception = self.make_sentry_payload(entry)
-        data = exception.to_dict()
+    async def _get_session(self) -> aiohttp.ClientSession:
+        # all the reports are sent through the same session, so that connections (and TLS sessions) can be reused
+        # the session must be created from within a coroutine, therefore we can't do this in __init__
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                # the handler limits the number of concurrent uploads anyway, so we don't need more connections than
+                # that
+                # mails usually arrive a few minutes apart, so idle connections are kept open a little longer than
+                # aiohttp's default 15 seconds to save some TLS handshakes
+                connector=aiohttp.TCPConnector(limit=32, keepalive_timeout=60),
+                # aiohttp waits up to 5 minutes by default, which would keep a worker busy for far too long in case
+                # the server hangs
+                timeout=aiohttp.ClientTimeout(total=10),
+                headers={
+                    # it would be great if the Auth object just had a method to create/update a headers dict
+                    "X-Sentry-Auth": str(self.sentry_auth.to_header()),
+                    # user agent isn't really necessary, but sentry-sdk sets it, too, so... why not
+                    "User-Agent": "NewPipe Crash Report Importer",
+                    # it's recommended by the Sentry docs to send a valid MIME type
+                    "Content-Type": "application/json",
+                },
+            )
+
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def _post(self, session: aiohttp.ClientSession, data: bytes):
+        async with session.post(self.sentry_store_url, data=data) as response:
+            # pretty crude way to recognize this issue, but it works well enough
+            if response.status == 403:
+                if "An event with the same ID already exists" in (
+                    await response.text()
+                ):
+                    raise AlreadyStoredError()
+
+            if response.status != 200:
+                raise GlitchtipError(response.status, await response.text())
 
-        url = self.sentry_store_url
+    async def save(self, entry: DatabaseEntry):
+        session = await self._get_session()
 
-        # it would be great if the Auth object just had a method to create/update a headers dict
-        headers = {
-            "X-Sentry-Auth": str(self.sentry_auth.to_header()),
-            # user agent isn't really necessary, but sentry-sdk sets it, too, so... why not
-            "User-Agent": "NewPipe Crash Report Importer",
-            # it's recommended by the Sentry docs to send a valid MIME type
-            "Content-Type": "application/json",
-        }
+        exception = self.make_sentry_payload(entry)
+        # the payload is only read by GlitchTip, so we can leave out the whitespace
+        data = json.dumps(exception.to_dict(), separators=(",", ":")).encode()
 
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                url, data=json.dumps(data), headers=headers
-            ) as response:
-                # pretty crude way to recognize this issue, but it works well enough
-                if response.status == 403:
-                    if "An event with the same ID already exists" in (
-                        await response.text()
-                    ):
-                        raise AlreadyStoredError()
-
-                if response.status != 200:
-                    raise GlitchtipError(response.status, await response.text())
+        for attempt in range(1, _MAX_ATTEMPTS + 1):
+            try:
+                await self._post(session, data)
+                return
+
+            except (asyncio.TimeoutError, aiohttp.ClientConnectionError) as e:
+                error = e
+
+            except GlitchtipError as e:
+                # client errors (e.g., failed authentication) won't go away by trying again
+                if e.status < 500:
+                    raise
+
+                error = e
+
+            if attempt == _MAX_ATTEMPTS:
+                raise error
+
+            delay = _RETRY_BASE_DELAY * 2 ** (attempt - 1)
+            logger.warning(
+                "Upload failed (attempt %d of %d), retrying in %.1fs: %s: %s",
+                attempt,
+                _MAX_ATTEMPTS,
+                delay,
+                type(error).__name__,
+                error,
+            )
+            await asyncio.sleep(delay)
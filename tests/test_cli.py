@@ -0,0 +1,43 @@
+import socket
+import unittest
+
+from click.testing import CliRunner
+
+from newpipe_crash_report_importer.cli import cli
+
+
+def find_closed_port() -> int:
+    # binding to port 0 makes the OS pick a free port, which is closed again right after
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class ImportTest(unittest.TestCase):
+    def test_unreachable_server_aborts_import(self):
+        runner = CliRunner()
+
+        with runner.isolated_filesystem():
+            for filename in ["a.eml", "b.eml"]:
+                with open(filename, "w") as f:
+                    f.write("Subject: test\n\ntest\n")
+
+            result = runner.invoke(
+                cli,
+                [
+                    "import",
+                    "--host",
+                    "127.0.0.1",
+                    "--port",
+                    str(find_closed_port()),
+                    "a.eml",
+                    "b.eml",
+                ],
+            )
+
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn("Could not connect to LMTP server", result.output)
+
+
+if __name__ == "__main__":
+    unittest.main()
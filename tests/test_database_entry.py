@@ -0,0 +1,38 @@
+import unittest
+from datetime import datetime
+from email.parser import Parser
+
+from newpipe_crash_report_importer import DatabaseEntry
+
+
+def make_mail(time: str):
+    return Parser().parsestr(
+        "From: a@example.com\n"
+        "To: crashreport@newpipe.net\n"
+        "Date: Mon, 10 Aug 2020 10:00:00 +0200\n"
+        "\n"
+        '{"package": "org.schabi.newpipe", "time": "%s", "exceptions": []}\n' % time
+    )
+
+
+class DatabaseEntryDateTest(unittest.TestCase):
+    def test_date_from_report(self):
+        entry = DatabaseEntry(make_mail("2020-08-10 09:58"))
+
+        self.assertEqual(entry.date, datetime(2020, 8, 10, 9, 58))
+
+    def test_date_from_report_accepts_what_strptime_accepts(self):
+        # strptime allows for whitespace in front of numbers, a different parser would fall back to the Date: header
+        # and therefore change the hash ID
+        entry = DatabaseEntry(make_mail("2024-01- 5 10:00"))
+
+        self.assertEqual(entry.date, datetime(2024, 1, 5, 10, 0))
+
+    def test_invalid_date_from_report_falls_back_to_date_header(self):
+        entry = DatabaseEntry(make_mail("2020-13-10 09:58"))
+
+        self.assertEqual(entry.timestamp, 1597046400)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,64 @@
+import unittest
+
+from newpipe_crash_report_importer import GlitchtipStorage
+from newpipe_crash_report_importer.exceptions import ParserError
+
+
+class ParseFrameTest(unittest.TestCase):
+    def assertFrame(self, frame, filename, function, package, lineno):
+        self.assertEqual(
+            (frame.filename, frame.function, frame.package, frame.lineno),
+            (filename, function, package, lineno),
+        )
+
+    def test_frame(self):
+        frame = GlitchtipStorage.parse_frame("org.schabi.newpipe.Foo.bar(Foo.java:12)")
+
+        self.assertFrame(frame, "Foo.java", "bar", "org.schabi.newpipe.Foo", 12)
+
+    def test_frame_followed_by_cause(self):
+        # the line breaks are replaced by spaces, so the last frame before a cause block carries the cause's message
+        frame = GlitchtipStorage.parse_frame(
+            "org.schabi.newpipe.Foo.bar(Foo.java:12) Caused by: "
+            "java.lang.IllegalStateException: Fragment not attached (state=2)"
+        )
+
+        self.assertFrame(frame, "Foo.java", "bar", "org.schabi.newpipe.Foo", 12)
+
+    def test_native_method(self):
+        frame = GlitchtipStorage.parse_frame(
+            "java.lang.Object.wait(Native Method) Caused by: "
+            "java.io.IOException: failed (HTTP 403)"
+        )
+
+        self.assertFrame(frame, "Native Method", "wait", "java.lang.Object", None)
+
+    def test_unknown_source(self):
+        frame = GlitchtipStorage.parse_frame(
+            "org.schabi.newpipe.Foo$$ExternalSyntheticLambda0.run(Unknown Source:2)"
+        )
+
+        self.assertFrame(
+            frame,
+            "Unknown Source",
+            "run",
+            "org.schabi.newpipe.Foo$$ExternalSyntheticLambda0",
+            2,
+        )
+
+    def test_unknown_source_without_line_number(self):
+        frame = GlitchtipStorage.parse_frame(
+            "org.schabi.newpipe.Foo$$Lambda$1.run(Unknown Source)"
+        )
+
+        self.assertFrame(
+            frame, "Unknown Source", "run", "org.schabi.newpipe.Foo$$Lambda$1", None
+        )
+
+    def test_invalid_frame(self):
+        with self.assertRaises(ParserError):
+            GlitchtipStorage.parse_frame("... 12 more")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,58 @@
+import json
+import unittest
+from email.parser import Parser
+
+from aiosmtpd.smtp import Envelope
+
+from newpipe_crash_report_importer import CrashReportHandler, DatabaseEntry
+
+
+# raw UTF-8 headers are valid input, as the server supports SMTPUTF8
+NON_ASCII_MAIL = """\
+From: Jürgen Müller <juergen@example.com>
+To: Crash Répört <crashreport@newpipe.net>
+Subject: Exception in NewPipe
+Date: Mon, 10 Aug 2020 10:00:00 +0200
+Content-Type: text/plain; charset=utf-8
+Content-Transfer-Encoding: 8bit
+
+{"package": "org.schabi.newpipe", "time": "2020-08-10 09:58", "exceptions": ["java.lang.RuntimeException: Größe\\n\\tat org.schabi.newpipe.Foo.bar(Foo.java:1)"]}
+""".replace(
+    "\n", "\r\n"
+).encode()
+
+
+class ConvertToRfc822MessageTest(unittest.TestCase):
+    def convert(self, content: bytes):
+        envelope = Envelope()
+        envelope.content = content
+        return CrashReportHandler.convert_to_rfc822_message(envelope)
+
+    def test_non_ascii_headers_are_str(self):
+        message = self.convert(NON_ASCII_MAIL)
+
+        self.assertEqual(message["from"], "Jürgen Müller <juergen@example.com>")
+        self.assertEqual(message["to"], "Crash Répört <crashreport@newpipe.net>")
+
+    def test_non_ascii_headers_keep_hash_id(self):
+        # the hash IDs of existing reports were calculated from mails parsed like this
+        expected = DatabaseEntry(Parser().parsestr(NON_ASCII_MAIL.decode()))
+        entry = DatabaseEntry(self.convert(NON_ASCII_MAIL))
+
+        self.assertEqual(entry.hash_id, expected.hash_id)
+
+    def test_non_ascii_headers_can_be_serialized(self):
+        entry = DatabaseEntry(self.convert(NON_ASCII_MAIL))
+
+        data = json.loads(entry.to_json())
+
+        self.assertEqual(data["to"], "Crash Répört <crashreport@newpipe.net>")
+
+    def test_invalid_utf8_does_not_fail(self):
+        message = self.convert(b"From: \xff@example.com\r\n\r\nbody\r\n")
+
+        self.assertEqual(message.get_payload(), "body\r\n")
+
+
+if __name__ == "__main__":
+    unittest.main()
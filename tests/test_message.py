@@ -0,0 +1,21 @@
+import unittest
+
+from newpipe_crash_report_importer import Message
+
+
+class SanitizeMessageTest(unittest.TestCase):
+    def test_plain_text_is_unchanged(self):
+        self.assertEqual(Message.sanitize_message("foo\r\nbar"), "foo\nbar")
+
+    def test_entities_are_normalized(self):
+        self.assertEqual(Message.sanitize_message("&eacute;"), "e\u0301")
+
+    def test_combining_characters_are_reordered_after_stripping_tags(self):
+        # removing the tags puts both combining characters next to each other, so NFKD has to reorder them
+        self.assertEqual(
+            Message.sanitize_message("\u00e1<b></b>\u0316"), "a\u0316\u0301"
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()